@@ -1,34 +1,62 @@
+from collections import Counter, defaultdict
 from datetime import timedelta
 import argparse
+import csv
+import itertools
 import json
+import logging
+import operator
 import random
 
 import matrix_generator
+from matrix_generator import MAT_INDEX, MAT_KEYS
 
-BATCH_MAP = ('"A"', '"B"', '"C"')
-MACHINE_MAP = ('"1"', '"2"')
+log = logging.getLogger(__name__)
+
+BATCH_MAP = ('A', 'B', 'C')
+MACHINE_MAP = ('1', '2')
 SAMPLE_MAP = ('1', '2', '3', '4', '5')
 
+# Batch & machine ID of a build before its first part is added
+UNASSIGNED = -1
+
 
 class Build(object):
     """Represents the contents of an Eiger build"""
 
+    __slots__ = (
+        'name',
+        'max_material',
+        '_parts',
+        '_base_name_counts',
+        '_print_time',
+        '_print_materials',
+        '_remaining',
+        '_batch',
+        '_machine',
+        '_first_part',
+    )
+
     def __init__(self, name, batch=None, machine=None, max_material={'CFA': 50, 'OFA': 800}):
         """Create a Build object
 
         @param name Unique identifier to be used for this build
-        @param batch
+        @param batch Batch ID, or None to take the first part's batch
+        @param machine Machine ID, or None to take the first part's machine
         """
         self.name = name
         self.max_material = max_material
 
-        self._parts = {}
+        self._parts = {}  # Keyed by (base name, cnd)
+        self._base_name_counts = Counter()
         self._print_time = 0
-        self._print_materials = {}
+        # Material counters are lists ordered by MAT_KEYS
+        self._print_materials = [0] * len(MAT_KEYS)
+        self._remaining = [max_material.get(mat, 0) for mat in MAT_KEYS]
 
         # One-time write variables
-        self._batch = batch
-        self._machine = machine
+        self._batch = UNASSIGNED if batch is None else batch
+        self._machine = UNASSIGNED if machine is None else machine
         self._first_part = True  # Used to ignore checks on first add
 
     def __repr__(self):
@@ -40,17 +68,17 @@ class Build(object):
         1x D256-XY-FF (RTD-1)
         ```
         """
-        parts = []
+        cnds = {base_name: [] for base_name in self._base_name_counts}
 
-        for base_name in self._parts:
-            num_parts = len(self._parts[base_name])
-            cnds = ','.join([
-                '{}-{}'.format(part.cnd, SAMPLE_MAP[part.sample])
-                for part in self._parts[base_name].values()
-            ])
-            parts.append('{}x {} ({})'.format(num_parts, base_name, cnds))
+        for (base_name, cnd), part in self._parts.items():
+            cnds[base_name].append(
+                '{}-{}'.format(cnd, SAMPLE_MAP[part.sample]))
 
-        return '\n'.join(parts)
+        return '\n'.join([
+            '{}x {} ({})'.format(len(cnds[base_name]), base_name,
+                                 ','.join(cnds[base_name]))
+            for base_name in cnds
+        ])
 
     def __str__(self):
         """Short string representation"""
@@ -65,87 +93,121 @@ class Build(object):
         Machine & batch ID are set if not already, material & print time
         counters are incremented
 
+        If this build belongs to a BuildCollection, add parts through
+        BuildCollection.add_part instead so the collection's indices stay
+        up to date
+
         @param part Test tuple containing name & part metadata
         @param ignore_checks True if checks should be ignored. Default False
 
         @raises RuntimeError if part could not be added
         """
-        if self._batch is None:
+        if not ignore_checks:
+            error = self.check_part(part)
+            if error is not None:
+                raise RuntimeError(error)
+
+        if self._batch == UNASSIGNED:
             self._batch = part.batch
-        if self._machine is None:
+        if self._machine == UNASSIGNED:
             self._machine = part.machine
+        self._first_part = False
+
+        part_key = (part.base_name, part.cnd)
+        if self._uses_material(part):
+            print_materials = self._print_materials
+            remaining = self._remaining
+
+            self._print_time += part.print_time
+            for idx, qty in enumerate(part.print_materials):
+                print_materials[idx] += qty
+                remaining[idx] -= qty
+
+        if part_key not in self._parts:
+            self._base_name_counts[part.base_name] += 1
+        self._parts[part_key] = part
+
+    def check_part(self, part):
+        """Checks if a part can be added to build
+
+        Checks build's constraints (typically max material, machine & batch
+        ID) without modifying the build. The first part added to a build is
+        always allowed
+
+        @param part Test tuple containing name & part metadata
+
+        @returns None if part can be added, otherwise a string describing the
+                 failed constraint
+        """
         if self._first_part:
-            self._first_part = False
-            ignore_checks = True
+            return None
 
         # Check batch & machine ID - they must match
-        if self._batch != part.batch and not ignore_checks:
-            print(ignore_checks)
-            raise RuntimeError('Part did not match Build batch ID')
-        if self._machine != part.machine and not ignore_checks:
-            raise RuntimeError('Part did not match Build machine ID')
-
-        # Seed the internal part list
-        try:
-            self._parts[part.base_name]
-        except KeyError:
-            self._parts[part.base_name] = {}
+        if self._batch != UNASSIGNED and self._batch != part.batch:
+            return 'Part did not match Build batch ID'
+        if self._machine != UNASSIGNED and self._machine != part.machine:
+            return 'Part did not match Build machine ID'
 
         # Check if we're already in here
-        if part.cnd in self._parts[part.base_name] and not ignore_checks:
-            raise RuntimeError('Part already in build')
-        if len(self._parts[part.base_name]) % part.print_max_samples == 0:
-            # Check material constraints
-            for key in part.print_materials:
-                if (((self.print_materials.get(key, 0)
-                      + part.print_materials[key])
-                          > self.max_material.get(key, 0))
-                      and not ignore_checks):
-                   raise RuntimeError('Part uses too much {}'.format(key))
-            # If we're here, we're adding the part. We only add material once
-            # per print_max_samples
-            self._print_time += part.print_time
-            for key in part.print_materials:
-                try:
-                    self._print_materials[key] += part.print_materials[key]
-                except KeyError:
-                    self._print_materials[key] = part.print_materials[key]
+        if (part.base_name, part.cnd) in self._parts:
+            return 'Part already in build'
+
+        # Check material constraints
+        if self._uses_material(part):
+            remaining = self._remaining
+            for idx, qty in enumerate(part.print_materials):
+                if qty > remaining[idx]:
+                    return 'Part uses too much {}'.format(MAT_KEYS[idx])
+
+        return None
+
+    def _uses_material(self, part):
+        """Checks if adding a part would use material & print time
 
-        # If everything above is fine, add part to list
-        self._parts[part.base_name].update({part.cnd: part})
+        Up to print_max_samples samples of a base test share one printed part,
+        so only the first sample of each printed part uses material
+
+        @param part Test tuple containing name & part metadata
+
+        @returns True if part would start a new printed part
+        """
+        num_parts = self._base_name_counts[part.base_name]
+        return num_parts % part.print_max_samples == 0
 
     @property
     def base_names(self):
         """Return base names in Build w/ 1 or more specimens"""
-        base_names = []
-        for base_name in self._parts:
-            if len(self._parts[base_name]):
-                base_names.append(base_name)
-        return base_names
+        return list(self._base_name_counts)
 
     @property
     def batch(self):
-        """Return assigned batch"""
+        """Return assigned batch, or UNASSIGNED"""
         return self._batch
 
     @property
     def machine(self):
-        """Return assigned machine"""
+        """Return assigned machine, or UNASSIGNED"""
         return self._machine
 
+    @property
+    def part_count(self):
+        """Return number of parts in build"""
+        return len(self._parts)
+
     @property
     def parts(self):
         """Returns a copied list containing all parts in build"""
-        parts = []
-        for base_name in self._parts:
-            for cnd in self._parts[base_name]:
-                parts.append(self._parts[base_name][cnd])
-        return parts
+        return list(self._parts.values())
 
     @property
     def print_materials(self):
         """Returns dictionary containing build's net use of materials"""
-        return self._print_materials
+        return dict(zip(MAT_KEYS, self._print_materials))
+
+    @property
+    def remaining_material(self):
+        """Returns dictionary containing build's remaining material"""
+        return dict(zip(MAT_KEYS, self._remaining))
 
     @property
     def print_time(self):
@@ -154,7 +216,14 @@ class Build(object):
 
 
 class BuildCollection(object):
-    """A collection of builds"""
+    """A collection of builds
+
+    The collection indexes its builds by batch, machine & base name. Once a
+    build belongs to a collection, parts must only be added to it through the
+    collection (assign_part, assign_parts or add_part) - calling
+    Build.add_part directly leaves the indices stale, and filter_builds will
+    return the wrong builds
+    """
 
     def __init__(self, num_builds=1, build_kwargs={}):
         """Create a number of uniqely identified builds to common params
@@ -169,6 +238,53 @@ class BuildCollection(object):
         self.build_kwargs = build_kwargs
         self.num_builds = num_builds
 
+        # Indices of builds by batch, machine & base name. Kept up to date as
+        # parts are added through the collection
+        self._by_batch = defaultdict(set)
+        self._by_machine = defaultdict(set)
+        self._by_base_name = defaultdict(set)
+        self._ids = {}
+        for idx in range(num_builds):
+            self._index_build(idx)
+
+    def add_part(self, build, part, ignore_checks=False):
+        """Add a part to a collection build, keeping indices up to date
+
+        Use this instead of Build.add_part for builds in a collection
+
+        @param build The collection Build to add to
+        @param part The Test tuple to add
+        @param ignore_checks True if checks should be ignored. Default False
+
+        @raises RuntimeError if part could not be added
+        """
+        idx = self._ids[build.name]
+        batch = build.batch
+        machine = build.machine
+
+        build.add_part(part, ignore_checks)
+
+        if build.batch != batch:
+            self._by_batch[batch].discard(idx)
+            self._by_batch[build.batch].add(idx)
+        if build.machine != machine:
+            self._by_machine[machine].discard(idx)
+            self._by_machine[build.machine].add(idx)
+        self._by_base_name[part.base_name].add(idx)
+
+    def _index_build(self, idx):
+        """Add a build to the collection indices
+
+        @param idx Index of build in collection
+        """
+        build = self.builds[idx]
+
+        self._ids[build.name] = idx
+        self._by_batch[build.batch].add(idx)
+        self._by_machine[build.machine].add(idx)
+        for base_name in build.base_names:
+            self._by_base_name[base_name].add(idx)
+
     def assign_part(self, part):
         """Assign a part to one of the collection builds.
 
@@ -182,34 +298,33 @@ class BuildCollection(object):
             machine=part.machine,
             materials=part.print_materials,
         )
-        eligible_builds= self.filter_builds(
+        eligible_builds = self.filter_builds(
             batch=part.batch,
             machine=part.machine,
             base_name=part.base_name,
         )
 
         while not part_assigned:
-            try:
-                expected_build = random.choice(eligible_builds)
-            except IndexError:
+            if eligible_builds:
+                idx = random.randrange(len(eligible_builds))
+                expected_build = eligible_builds[idx]
+            elif eligible_builds_lazy is not None:
                 # If we're empty, either move off of the strict list or spawn a
                 # new build
-                if eligible_builds_lazy is not None:
-                    print('No good match, being lazy')
-                    eligible_builds = eligible_builds_lazy
-                    eligible_builds_lazy = None
-                    continue
-                else:
-                    print('No match, new build!')
-                    expected_build = self.spawn_build()
-            try:
-                expected_build.add_part(part)
-                print('{} assigned to {}'.format(part.name, expected_build))
+                log.debug('No good match, being lazy')
+                eligible_builds = eligible_builds_lazy
+                eligible_builds_lazy = None
+                continue
+            else:
+                log.debug('No match, new build!')
+                idx = None
+                expected_build = self.spawn_build()
+            if self._try_add(expected_build, part):
                 part_assigned = True
-            except RuntimeError as e:
-                eligible_builds.remove(expected_build)
-                print('{} failed - {}. Trying again'.format(
-                    expected_build, e.args[0]))
+            elif idx is not None:
+                # Drop the failed build by moving the last build into its slot
+                eligible_builds[idx] = eligible_builds[-1]
+                eligible_builds.pop()
 
     def assign_parts(self, parts):
         """Assign multiple parts to collection
@@ -220,17 +335,86 @@ class BuildCollection(object):
 
         @param parts Iterable of Test tuples to add
         """
-        max_material = {k: v for k,  v in sorted(
-            self.builds[0].max_material.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )}
+        max_material = self.builds[0].max_material
+        # Most constrained (lowest max) material first. Materials with equal
+        # max are ordered last-listed first, matching the original one sort
+        # per material - don't drop the reversed() or the part order changes
+        priority_keys = sorted(reversed(list(max_material)),
+                               key=max_material.get)
+
+        # One stable sort on all materials at once, in priority order
+        materials = operator.itemgetter(
+            *[MAT_INDEX[key] for key in priority_keys])
+        parts.sort(key=lambda x: materials(x.print_materials), reverse=True)
+
+        # Runs of parts differing only by sample have the same eligible
+        # builds, so only filter once per run
+        groups = itertools.groupby(
+            parts, key=lambda x: (x.batch, x.machine, x.base_name, x.cnd))
+
+        for (batch, machine, base_name, _), group in groups:
+            group = list(group)
+            eligible_builds_lazy = self.filter_builds(
+                batch=batch,
+                machine=machine,
+                materials=group[0].print_materials,
+            )
+            eligible_builds = self.filter_builds(
+                batch=batch,
+                machine=machine,
+                base_name=base_name,
+            )
+            random.shuffle(eligible_builds_lazy)
+            random.shuffle(eligible_builds)
+
+            for part in group:
+                self._assign_to_eligible(
+                    part, eligible_builds, eligible_builds_lazy)
+
+    def _assign_to_eligible(self, part, eligible_builds, eligible_builds_lazy):
+        """Assign a part to the last build in the eligible lists that fits
+
+        Builds the part cannot be added to are dropped from the lists. If no
+        build fits, spawn a new build. Builds the part is added to are moved
+        to the strict list.
 
-        for key in max_material:
-            parts.sort(key=lambda x: x.print_materials[key], reverse=True)
+        @param part The Test tuple to add
+        @param eligible_builds List of builds already containing part base name
+        @param eligible_builds_lazy List of builds w/ enough remaining material
+        """
+        while eligible_builds:
+            if self._try_add(eligible_builds[-1], part):
+                return
+            eligible_builds.pop()
+
+        log.debug('No good match, being lazy')
+        while eligible_builds_lazy:
+            expected_build = eligible_builds_lazy.pop()
+            if self._try_add(expected_build, part):
+                eligible_builds.append(expected_build)
+                return
+
+        log.debug('No match, new build!')
+        expected_build = self.spawn_build()
+        self._try_add(expected_build, part)
+        eligible_builds.append(expected_build)
+
+    def _try_add(self, build, part):
+        """Attempt to add a part to a collection build
+
+        @param build The collection Build to add to
+        @param part The Test tuple to add
 
-        for part in parts:
-            self.assign_part(part)
+        @returns True if part was added, False otherwise
+        """
+        error = build.check_part(part)
+        if error is not None:
+            log.debug('%s failed - %s. Trying again', build, error)
+            return False
+
+        self.add_part(build, part, ignore_checks=True)
+        log.debug('%s assigned to %s', part.name, build)
+        return True
 
     def build_summary(self):
         """Returns a string representing each build w/ metadata"""
@@ -239,14 +423,14 @@ class BuildCollection(object):
         for build in self.builds:
             retstr.append('- {}:\t{} parts\t{}\t({})'.format(
                 build.name,
-                len(build.parts),
+                build.part_count,
                 build.print_materials,
                 timedelta(seconds=build.print_time)
             ))
 
         return '\n'.join(retstr)
 
-    def filter_builds(self, batch=None, machine=None, materials={}, base_name=None):
+    def filter_builds(self, batch=None, machine=None, materials=(), base_name=None):
         """Filters build list based on desired parameters.
 
         Material content will not be checked if base name is specified due to
@@ -254,26 +438,35 @@ class BuildCollection(object):
 
         @param batch Desired batch to match
         @param machine Desired machine to match
-        @param materials Dict containing desired remaining material, in cc
+        @param materials Tuple of desired remaining material in cc, ordered by
+                         MAT_KEYS
         @param base_name Base name of part
 
         @returns A filtered list of the desired builds
         """
+        candidates = []
         if batch is not None:
-            builds = [build for build in self.builds
-                      if build.batch == batch or build.batch is None]
+            candidates.append(
+                self._by_batch[UNASSIGNED] | self._by_batch[batch])
         if machine is not None:
-            builds = [build for build in builds
-                      if build.machine == machine or build.machine is None]
+            candidates.append(
+                self._by_machine[UNASSIGNED] | self._by_machine[machine])
         if base_name is not None:
-            builds = [build for build in builds
-                      if base_name in build.base_names]
+            candidates.append(self._by_base_name[base_name])
+
+        if candidates:
+            ids = set.intersection(*candidates)
         else:
-            for key in materials:
-                builds = [build for build in builds
-                          if (build.max_material.get(key, 0)
-                              - build.print_materials.get(key, 0))
-                             >= materials[key]]
+            ids = range(len(self.builds))
+
+        all_builds = self.builds
+        builds = [all_builds[idx] for idx in sorted(ids)]
+        if base_name is None:
+            # Only materials the part uses can rule a build out
+            for idx, qty in enumerate(materials):
+                if qty:
+                    builds = [build for build in builds
+                              if build._remaining[idx] >= qty]
 
         return builds
 
@@ -284,6 +477,7 @@ class BuildCollection(object):
             **self.build_kwargs
         ))
         self.num_builds += 1
+        self._index_build(len(self.builds) - 1)
 
         return self.builds[-1]
 
@@ -292,21 +486,23 @@ class BuildCollection(object):
 
         @param filename Name of file to save results to
         """
-        part_list = []
-        for build in self.builds:
-            part_list.append(','.join([
-                '"{}"'.format(build),
-                '"{}"'.format(repr(build)),
-                BATCH_MAP[build.batch],
-                MACHINE_MAP[build.machine],
-                '"{}"'.format(str(build.print_time)),
-                *['"{}"'.format(mat) for mat in {
-                    k: v for k, v in sorted(build.print_materials.items())
-                 }.values()],
-                ]))
-
-        with open(filename, 'w') as output_file:
-            output_file.write('\n'.join(part_list))
+        # Material columns are in alphabetical order
+        mat_order = [MAT_INDEX[mat] for mat in sorted(MAT_KEYS)]
+
+        with open(filename, 'w', newline='') as output_file:
+            writer = csv.writer(
+                output_file, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            for build in self.builds:
+                writer.writerow([
+                    build,
+                    repr(build),
+                    ('' if build.batch == UNASSIGNED
+                     else BATCH_MAP[build.batch]),
+                    ('' if build.machine == UNASSIGNED
+                     else MACHINE_MAP[build.machine]),
+                    build.print_time,
+                    *[build._print_materials[idx] for idx in mat_order],
+                ])
 
 
 if __name__ == '__main__':
@@ -321,9 +517,13 @@ if __name__ == '__main__':
                         help='Number of builds to start in collection')
     parser.add_argument('--seed', '-s', default=None, type=int,
                         help='Random seed')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Log each part assignment')
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
     if args.seed is None:
         args.seed = random.randrange(2 ** 31 - 1)
     print('\nSeed is: {}'.format(args.seed))
@@ -1,6 +1,7 @@
 from collections import namedtuple
 import argparse
 import json
+import logging
 
 Test = namedtuple("Test", [
     "name",
@@ -14,26 +15,11 @@ Test = namedtuple("Test", [
     "print_max_samples",
 ])
 
+# Material order used by Test.print_materials
+MAT_KEYS = ('CFA', 'OFA')
+MAT_INDEX = {mat: idx for idx, mat in enumerate(MAT_KEYS)}
 
-def _concat_name(base=None, ext=None):
-    """Helper for generating test names
-
-    When given two arguments, <ext> is appended to <base> via a hyphen. If
-    given only one argument, that argument is returned by itself.
-
-    @param base String to be appended to
-    @param ext String to append
-
-    @returns Generated string
-    """
-    strs = []
-
-    if base is not None:
-        strs.append(base)
-    if ext is not None:
-        strs.append(ext)
-
-    return '-'.join(strs)
+log = logging.getLogger(__name__)
 
 
 def matrix_to_list(matrix, test_name=None):
@@ -56,25 +42,27 @@ def matrix_to_list(matrix, test_name=None):
     @returns List of all tests defined in matrix
     """
     test_list = []
-
-    for key in matrix:
-        print('Checking {}'.format(key))
-        print('Test is now named {}'.format(_concat_name(test_name, key)))
-        try:
-            if 'print-material' in matrix[key] and 'print-time' in matrix[key]:
-                print('Found base test!')
-                test_list.extend(tests_to_list(
-                    matrix[key], _concat_name(test_name, key)
-                ))
+    # Each entry holds an iterator over a level of the tree & that level's
+    # name, so tests are listed in the same order as the matrix
+    stack = [(iter(matrix.items()), test_name)]
+
+    while stack:
+        items, prefix = stack[-1]
+        for key, value in items:
+            name = key if prefix is None else '-'.join((prefix, key))
+            log.debug('Checking %s', key)
+            log.debug('Test is now named %s', name)
+            if not isinstance(value, dict):
+                log.warning('%s missing metadata!', name)
+            elif 'print-material' in value and 'print-time' in value:
+                log.debug('Found base test!')
+                test_list.extend(tests_to_list(value, name))
             else:
-                print('No base, recursing')
-                print('Passing along {}'.format(test_name))
-                test_list.extend(matrix_to_list(
-                    matrix[key], _concat_name(test_name, key)
-                ))
-        except TypeError:
-            print('{} missing metadata!'.format(test_name))
-            continue
+                log.debug('No base, descending')
+                stack.append((iter(value.items()), name))
+                break
+        else:
+            stack.pop()
 
     return test_list
 
@@ -97,33 +85,51 @@ def tests_to_list(matrix, test_name):
     and will return a list that looks like this:
     ```
     [
-        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, {<mat>: <qty>, ...}),
-        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, {<mat>: <qty>, ...}),
-        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, {<mat>: <qty>, ...}),
+        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, (<qty>, ...)),
+        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, (<qty>, ...)),
+        (<test>-<cnd>-<batch>-<machine>-<sample>, <time>, (<qty>, ...)),
         ....
     ]
 
+    Material quantities are stored as a tuple ordered by MAT_KEYS, shared
+    between all tests in the group. Materials not listed default to zero
+
     Samples may optionally specify a "print_max_samples" field, denoting how
     many samples can fit into a single printable part. If not present, this
     field will be set to one
 
+    Conditions without integer "B", "M" and "S" counts are skipped with a
+    warning
+
     @param matrix Dictionary containing test
     @param test_name Name of test
 
     @returns List of test tuples
+
+    @raises ValueError if a material is not in MAT_KEYS
     """
-    materials = {}
+    materials = [0] * len(MAT_KEYS)
     test_list = []
 
     print_time = matrix.pop('print-time')
     for mat, qty in matrix.pop('print-material').items():
-        materials[mat] = qty
+        if mat not in MAT_INDEX:
+            raise ValueError('{} uses unknown material {}'.format(
+                test_name, mat))
+        materials[MAT_INDEX[mat]] = qty
+    materials = tuple(materials)
     print_max_samples = matrix.pop('print-max-samples', 1)
 
-    for cnd in matrix:
-        for batch in range(matrix[cnd]['B']):
-            for machine in range(matrix[cnd]['M']):
-                for sample in range(matrix[cnd]['S']):
+    for cnd, counts in matrix.items():
+        # Skip conditions that aren't {"B": <int>, "M": <int>, "S": <int>}
+        if not (isinstance(counts, dict)
+                and all(isinstance(counts.get(key), int) for key in 'BMS')):
+            log.warning('%s-%s missing metadata!', test_name, cnd)
+            continue
+
+        for batch in range(counts['B']):
+            for machine in range(counts['M']):
+                for sample in range(counts['S']):
                     full_test = '{}-{}-B{}-M{}-S{}'.format(
                         test_name, cnd, batch, machine, sample)
                     test_list.append(Test(
@@ -149,9 +155,13 @@ if __name__ == '__main__':
     parser.add_argument('test_matrix', help='File containing test matrix JSON')
     parser.add_argument('output', default='test-list.csv', nargs='?',
                         help='Name of file to store output CSV to')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Log each step of the matrix search')
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
     # Load matrix
     with open(args.test_matrix, 'r') as test_matrix_file:
         test_matrix = json.load(test_matrix_file)
@@ -163,6 +173,6 @@ if __name__ == '__main__':
             test_list_file.write(','.join((
                 test.name,
                 str(test.print_time),
-                *[str(value) for key, value in test.print_materials.items()]
+                *[str(qty) for qty in test.print_materials]
             )))
             test_list_file.write('\n')